@@ -9,22 +9,114 @@ import os
 import re
 import subprocess
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from xmlrpc.client import ServerProxy
 import numpy as np
 import psutil
 
 # ROS
 import rospy
-import tf
+import tf2_ros
 import rosnode
 import rosgraph
 
 # msgs
 from std_msgs.msg import Bool, Float32
-from std_srvs.srv import SetBool
-from std_srvs.srv import Trigger
+from std_srvs.srv import SetBool, SetBoolRequest
+from std_srvs.srv import Trigger, TriggerRequest
 from voxblox_msgs.srv import FilePath
 
+# Converts a quaternion half-angle in radians to the full angle in degrees
+RAD_TO_DEG_DOUBLED = 360.0 / math.pi
+
+# TF frames used to evaluate the drift and the distance traveled
+LIDAR_FRAME = 'airsim_drone/Lidar'
+LIDAR_GROUND_TRUTH_FRAME = 'airsim_drone/Lidar_ground_truth'
+DRONE_GROUND_TRUTH_FRAME = 'airsim_drone_ground_truth'
+ODOM_FRAME = 'odom'
+INITIAL_POSE_FRAME = 'initial_pose'
+
+# Columns of the evaluation data, stored as one record per evaluation.
+# NOTE: MapName holds the zero padded map index, 10 digits never truncate
+EVAL_DATA_TYPE = np.dtype([
+    ('MapName', 'U10'), ('RosTime', 'f8'), ('WallTime', 'f8'),
+    ('PositionDrift', 'f8'), ('RotationDrift', 'f8'),
+    ('PositionDriftEstimated', 'f8'), ('RotationDriftEstimated', 'f8'),
+    ('DistanceTraveled', 'f8'), ('CpuFrequency', 'f8'),
+    ('TotalWallTime', 'f8'), ('TotalCpuTime', 'f8'),
+    ('TotalCpuPercent', 'f8'), ('TotalMemoryPercent', 'f8'),
+    ('PlannerWallTime', 'f8'), ('PlannerCpuTime', 'f8'),
+    ('PlannerCpuPercent', 'f8'), ('PlannerMemoryPercent', 'f8'),
+    ('GlocalPlanningCpuTime', 'f8')
+])
+
+# Evaluation data columns that are NaN while the transforms are missing
+DRIFT_FIELDS = ('PositionDrift', 'RotationDrift', 'PositionDriftEstimated',
+                'RotationDriftEstimated')
+
+# Default names of the temporary rosbags
+BAG_EXPR = re.compile(r'tmp_bag_\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}\.bag.')
+
+
+def _homogeneous_matrix(t, r):
+    """ Build the 4x4 transform for translation t and quaternion r (x, y,
+    z, w), equivalent to translation_matrix(t) * quaternion_matrix(r) """
+    x, y, z, w = r
+    nq = x * x + y * y + z * z + w * w
+    m = np.empty((4, 4))
+    if nq < 1e-12:
+        m[:3, :3] = np.identity(3)
+    else:
+        s = 2.0 / nq
+        xx, yy, zz = s * x * x, s * y * y, s * z * z
+        xy, xz, yz = s * x * y, s * x * z, s * y * z
+        wx, wy, wz = s * w * x, s * w * y, s * w * z
+        m[0, 0] = 1.0 - yy - zz
+        m[0, 1] = xy - wz
+        m[0, 2] = xz + wy
+        m[1, 0] = xy + wz
+        m[1, 1] = 1.0 - xx - zz
+        m[1, 2] = yz - wx
+        m[2, 0] = xz - wy
+        m[2, 1] = yz + wx
+        m[2, 2] = 1.0 - xx - yy
+    m[:3, 3] = t
+    m[3, :] = (0.0, 0.0, 0.0, 1.0)
+    return m
+
+
+def _homogeneous_matrix_from_msg(transform):
+    """ Build the 4x4 transform for a geometry_msgs/Transform """
+    t = transform.translation
+    r = transform.rotation
+    return _homogeneous_matrix((t.x, t.y, t.z), (r.x, r.y, r.z, r.w))
+
+
+def _quaternion_from_matrix(m):
+    """ Extract the quaternion (x, y, z, w) from a 4x4 transform, same
+    as tf.transformations.quaternion_from_matrix """
+    q = np.empty(4)
+    t = m[0, 0] + m[1, 1] + m[2, 2] + m[3, 3]
+    if t > m[3, 3]:
+        q[3] = t
+        q[2] = m[1, 0] - m[0, 1]
+        q[1] = m[0, 2] - m[2, 0]
+        q[0] = m[2, 1] - m[1, 2]
+    else:
+        i, j, k = 0, 1, 2
+        if m[1, 1] > m[0, 0]:
+            i, j, k = 1, 2, 0
+        if m[2, 2] > m[i, i]:
+            i, j, k = 2, 0, 1
+        t = m[i, i] - (m[j, j] + m[k, k]) + m[3, 3]
+        q[i] = t
+        q[j] = m[i, j] + m[j, i]
+        q[k] = m[k, i] + m[i, k]
+        q[3] = m[k, j] - m[j, k]
+    q *= 0.5 / math.sqrt(t * m[3, 3])
+    return q
+
 
 class ResourceMonitor(object):
     def __init__(self, ros_node_name, verbose=False):
@@ -137,30 +229,41 @@ class ResourceMonitor(object):
 
 
 class EvalData(object):
+    # Write buffer size in bytes for the data and log files
+    FILE_BUFFER_SIZE = 1 << 16
+    # Number of evaluation rows collected before writing them to disk
+    ROW_BATCH_SIZE = 10
+    # Initial number of evaluation records, grows by doubling when full
+    EVAL_DATA_CAPACITY = 1024
+    # Timestamp prefix of every line in the log file
+    LOG_TIME_FORMAT = "[%Y-%m-%d %H:%M:%S] "
+
     def __init__(self):
         '''  Initialize ros node and read params '''
         # Parse parameters
-        self.ns_planner = rospy.get_param(
+        self.ns_planner = rospy.get_param_cached(
             '~ns_planner', "/glocal/glocal_system/toggle_running")
-        self.planner_delay = rospy.get_param(
+        self.planner_delay = rospy.get_param_cached(
             '~delay', 0.0)  # Waiting time until the planner is launched
-        self.startup_timeout = rospy.get_param(
+        self.startup_timeout = rospy.get_param_cached(
             '~startup_timeout', 0.0)  # Max allowed time for startup, 0 for inf
 
-        self.evaluate = rospy.get_param(
+        self.evaluate = rospy.get_param_cached(
             '~evaluate', False)  # Periodically save the voxblox state
-        self.eval_frequency = rospy.get_param('~eval_frequency',
-                                              30.0)  # Save rate in seconds
-        self.time_limit = rospy.get_param(
+        self.eval_frequency = rospy.get_param_cached(
+            '~eval_frequency', 30.0)  # Save rate in seconds
+        self.time_limit = rospy.get_param_cached(
             '~time_limit', 0.0)  # Maximum sim duration in minutes, 0 for inf
+        self.time_limit_s = self.time_limit * 60.0 \
+            if self.time_limit > 0.0 else float('inf')
 
         # Name of the node whose resource usage we measure
-        self.planner_node_name = rospy.get_param('~planner_node_name',
-                                                 '/glocal_system')
-        self.glocal_planning_cpu_time_topic = rospy.get_param(
+        self.planner_node_name = rospy.get_param_cached(
+            '~planner_node_name', '/glocal_system')
+        self.glocal_planning_cpu_time_topic = rospy.get_param_cached(
             '~total_planning_cpu_time', '/glocal/total_planning_cpu_time')
-        self.run_planner_srv_type = rospy.get_param('~planner_start_srv_type',
-                                                    'SetBool')
+        self.run_planner_srv_type = rospy.get_param_cached(
+            '~planner_start_srv_type', 'SetBool')
 
         self.eval_walltime_0 = None
         self.eval_rostime_0 = None
@@ -168,7 +271,7 @@ class EvalData(object):
 
         if self.evaluate:
             # Setup parameters
-            self.eval_directory = rospy.get_param(
+            self.eval_directory = rospy.get_param_cached(
                 '~eval_directory',
                 'DirParamNotSet')  # Periodically save voxblox map
             if not os.path.isdir(self.eval_directory):
@@ -176,18 +279,22 @@ class EvalData(object):
                                self.eval_directory)
                 sys.exit(-1)
 
-            self.ns_voxblox = rospy.get_param('~ns_voxblox',
-                                              "/voxblox/voxblox_node")
+            self.ns_voxblox = rospy.get_param_cached('~ns_voxblox',
+                                                     "/voxblox/voxblox_node")
 
             # Statistics
             self.eval_n_maps = 0
+            self.eval_data = np.empty(self.EVAL_DATA_CAPACITY,
+                                      dtype=EVAL_DATA_TYPE)
+            self.eval_n_written = 0
             self.distance_traveled = 0
             self.previous_position = None
             self.collided = False
             self.run_planner_srv = None
+            self.run_planner_request = None
 
             # placeholders
-            self.eval_timer = None
+            self.eval_thread = None
             self.dist_timer = None
             self.initial_point_offset = None
             self.planner_resource_monitor = ResourceMonitor(
@@ -203,28 +310,27 @@ class EvalData(object):
                 datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
             os.mkdir(self.eval_directory)
             os.mkdir(os.path.join(self.eval_directory, "voxblox_maps"))
-            self.eval_data_file = open(
-                os.path.join(self.eval_directory, "voxblox_data.csv"), 'wb')
+            self.map_path_template = os.path.join(self.eval_directory,
+                                                  "voxblox_maps", "%05d.vxblx")
+            self.eval_data_file = open(os.path.join(self.eval_directory,
+                                                    "voxblox_data.csv"),
+                                       'w',
+                                       newline='',
+                                       buffering=self.FILE_BUFFER_SIZE)
             self.eval_writer = csv.writer(self.eval_data_file,
                                           delimiter=',',
                                           quotechar='|',
                                           quoting=csv.QUOTE_MINIMAL,
                                           lineterminator='\n')
-            self.eval_writer.writerow([
-                'MapName', 'RosTime', 'WallTime', 'PositionDrift',
-                'RotationDrift', 'PositionDriftEstimated',
-                'RotationDriftEstimated', 'DistanceTraveled', 'CpuFrequency',
-                'TotalWallTime', 'TotalCpuTime', 'TotalCpuPercent',
-                'TotalMemoryPercent', 'PlannerWallTime', 'PlannerCpuTime',
-                'PlannerCpuPercent', 'PlannerMemoryPercent',
-                'GlocalPlanningCpuTime'
-            ])
+            self.eval_writer.writerow(EVAL_DATA_TYPE.names)
             self.eval_writer.writerow([
                 'Unit', 's', 's', 'm', 'deg', 'm', 'deg', 'm', 'MHz', 's', 's',
                 'Percent', 'Percent', 's', 's', 'Percent', 'Percent', 's'
             ])
-            self.eval_log_file = open(
-                os.path.join(self.eval_directory, "data_log.txt"), 'a')
+            self.eval_log_file = open(os.path.join(self.eval_directory,
+                                                   "data_log.txt"),
+                                      'a',
+                                      buffering=self.FILE_BUFFER_SIZE)
 
             # Subscribers, Services
             self.collision_sub = rospy.Subscriber("collision",
@@ -236,7 +342,9 @@ class EvalData(object):
                 Float32,
                 self.glocal_planning_cpu_time_callback,
                 queue_size=1)
-            self.tf_listener = tf.TransformListener()
+            self.tf_buffer = tf2_ros.Buffer()
+            self.tf_latest = rospy.Time(0)  # Latest available transform
+            self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)
 
             # Finish
             self.writelog("Data folder created at '%s'." % self.eval_directory)
@@ -244,6 +352,13 @@ class EvalData(object):
                           self.eval_directory)
             self.eval_voxblox_service = rospy.ServiceProxy(
                 self.ns_voxblox + "/save_map", FilePath)
+            # Maps are saved in the background, one at a time
+            self.save_map_pool = ThreadPoolExecutor(max_workers=1)
+            self.save_map_future = None
+            # Guards recording data against eval_finish, which runs on the
+            # thread that triggers the shutdown
+            self.eval_lock = threading.Lock()
+            self.eval_finished = False
             rospy.on_shutdown(self.eval_finish)
 
         self.launch_simulation()
@@ -293,14 +408,19 @@ class EvalData(object):
             )
         if 'SetBool' in self.run_planner_srv_type:
             self.run_planner_srv = rospy.ServiceProxy(self.ns_planner, SetBool)
-            self.run_planner_srv(True)
+            self.run_planner_request = SetBoolRequest(True)
+            self.run_planner_srv.call(self.run_planner_request)
         elif 'Trigger' in self.run_planner_srv_type:
             self.run_planner_srv = rospy.ServiceProxy(self.ns_planner, Trigger)
-            self.run_planner_srv()
+            self.run_planner_request = TriggerRequest()
+            self.run_planner_srv.call(self.run_planner_request)
         else:
             rospy.logfatal(
                 "Planner service type should be SetBool or Trigger, "
                 "but is: %s" % self.run_planner_srv_type)
+            self.stop_experiment("Unknown planner service type '%s'." %
+                                 self.run_planner_srv_type)
+            return
 
         # Setup first measurements
         self.eval_walltime_0 = time.time()
@@ -319,20 +439,16 @@ class EvalData(object):
             self.eval_n_maps = 0
 
             # Keep track of the (most recent) rosbag
-            bag_expr = re.compile(
-                r'tmp_bag_\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}\.bag.'
-            )  # Default names
-            bags = [
-                b for b in os.listdir(
+            with os.scandir(
                     os.path.join(os.path.dirname(self.eval_directory),
-                                 "tmp_bags")) if bag_expr.match(b)
-            ]
-            bags.sort(reverse=True)
-            if bags:
+                                 "tmp_bags")) as entries:
+                bag = max((e.name for e in entries if BAG_EXPR.match(e.name)),
+                          default=None)
+            if bag is not None:
                 self.writelog("Registered '%s' as bag for this experiment." %
-                              bags[0])
+                              bag)
                 self.eval_log_file.write("[FLAG] Rosbag: %s\n" %
-                                         bags[0].split('.')[0])
+                                         bag.split('.')[0])
             else:
                 rospy.logwarn(
                     "[ExperimentManager]: No tmpbag found. Is rosbag recording?"
@@ -341,25 +457,44 @@ class EvalData(object):
 
             # Periodic evaluation (call once for initial measurement)
             self.eval_callback(None)
-            self.eval_timer = rospy.Timer(rospy.Duration(self.eval_frequency),
-                                          self.eval_callback)
+            self.eval_thread = threading.Thread(target=self.eval_loop)
+            self.eval_thread.daemon = True
+            self.eval_thread.start()
             self.dist_timer = rospy.Timer(rospy.Duration(0.1),
                                           self.distance_callback)
 
         # Finish
-        rospy.loginfo("\n" + "*" * 40 +
-                      "\n* Successfully started the experiment! *\n" +
-                      "*" * 40)
+        banner = "*" * 40
+        rospy.loginfo("\n%s\n* Successfully started the experiment! *\n%s",
+                      banner, banner)
+
+    def eval_loop(self):
+        """ Periodically evaluate, ticks that are missed while an evaluation
+        is still running are skipped instead of queued """
+        rate = rospy.Rate(1.0 / self.eval_frequency)
+        while not rospy.is_shutdown():
+            try:
+                rate.sleep()
+            except rospy.ROSInterruptException:
+                # Also raised if the sim time moves backwards, only stop
+                # evaluating once the node is shutting down
+                if not rospy.is_shutdown():
+                    rospy.logwarn("[ExperimentManager]: ROS time moved "
+                                  "backwards, skipping evaluation.")
+                continue
+            if not rospy.is_shutdown():
+                try:
+                    self.eval_callback(None)
+                except rospy.ROSInterruptException:
+                    # Service calls are interrupted when shutting down
+                    return
 
     def eval_callback(self, _):
         # Check whether the planner is still alive
         try:
             # If planner is running calling this service again does nothing
-            if 'SetBool' in self.run_planner_srv_type:
-                self.run_planner_srv(True)
-            elif 'Trigger' in self.run_planner_srv_type:
-                self.run_planner_srv()
-        except:
+            self.run_planner_srv.call(self.run_planner_request)
+        except rospy.ServiceException:
             # Usually this means the planner died
             self.stop_experiment("Planner Node died.")
             return
@@ -367,106 +502,123 @@ class EvalData(object):
         # Produce a data point
         time_real = time.time() - self.eval_walltime_0
         time_ros = rospy.get_time() - self.eval_rostime_0
-        map_name = "{0:05d}".format(self.eval_n_maps)
+        map_name = "%05d" % self.eval_n_maps
 
         # Compute transform errors
-        drift_pos = None
-        drift_rot = 0
-        try:
-            (t, r) = self.tf_listener.lookupTransform(
-                'airsim_drone/Lidar', 'airsim_drone/Lidar_ground_truth',
-                rospy.Time(0))
-        except (tf.LookupException, tf.ConnectivityException,
-                tf.ExtrapolationException):
-            drift_pos = 0
-        if drift_pos is None:
-            r = np.array(r)
+        # NOTE: Checking availability first avoids raising and catching tf
+        #       exceptions while the transforms are not yet published
+        drift_pos = np.nan
+        drift_rot = np.nan
+        if self.tf_buffer.can_transform(LIDAR_FRAME, LIDAR_GROUND_TRUTH_FRAME,
+                                        self.tf_latest):
+            transform = self.tf_buffer.lookup_transform(
+                LIDAR_FRAME, LIDAR_GROUND_TRUTH_FRAME, self.tf_latest).transform
+            t = transform.translation
+            r = transform.rotation
+            drift_pos = math.sqrt(t.x * t.x + t.y * t.y + t.z * t.z)
+            drift_rot = RAD_TO_DEG_DOUBLED * math.acos(
+                r.w / math.sqrt(r.x * r.x + r.y * r.y + r.z * r.z + r.w * r.w))
+
+        drift_estimated_pos = np.nan
+        drift_estimated_rot = np.nan
+        if self.initial_point_offset is not None and \
+                self.tf_buffer.can_transform(ODOM_FRAME, INITIAL_POSE_FRAME,
+                                             self.tf_latest):
+            transform = self.tf_buffer.lookup_transform(
+                ODOM_FRAME, INITIAL_POSE_FRAME, self.tf_latest).transform
+            trans = np.dot(_homogeneous_matrix_from_msg(transform),
+                           self.initial_point_offset)
+            t = trans[:3, 3]
+            r = _quaternion_from_matrix(trans)
+            drift_estimated_pos = math.sqrt(t[0] * t[0] + t[1] * t[1] +
+                                            t[2] * t[2])
             r = r / np.linalg.norm(r)
-            drift_pos = (t[0]**2 + t[1]**2 + t[2]**2)**0.5
-            drift_rot = 2 * math.acos(r[3]) * 180.0 / math.pi
-
-        drift_estimated_pos = None
-        drift_estimated_rot = 0
-
-        try:
-            (t, r) = self.tf_listener.lookupTransform('odom', 'initial_pose',
-                                                      rospy.Time(0))
-        except (tf.LookupException, tf.ConnectivityException,
-                tf.ExtrapolationException):
-            drift_estimated_pos = 0
-        if drift_estimated_pos is None:
-            if self.initial_point_offset is None:
-                drift_estimated_pos = 0
-            else:
-                trans = np.dot(tf.transformations.translation_matrix(t),
-                               tf.transformations.quaternion_matrix(r))
-
-                trans = tf.transformations.concatenate_matrices(
-                    trans, self.initial_point_offset)
-                t = tf.transformations.translation_from_matrix(trans)
-                r = tf.transformations.quaternion_from_matrix(trans)
-                drift_estimated_pos = (t[0]**2 + t[1]**2 + t[2]**2)**0.5
-                r = np.array(r)
-                r = r / np.linalg.norm(r)
-                drift_estimated_rot = 2 * math.acos(r[3]) * 180.0 / math.pi
+            drift_estimated_rot = RAD_TO_DEG_DOUBLED * math.acos(r[3])
 
         # Gather system resource usage stats
         self.planner_resource_monitor.update_stats()
 
-        self.eval_writer.writerow([
-            map_name, time_ros, time_real, drift_pos, drift_rot,
-            drift_estimated_pos, drift_estimated_rot, self.distance_traveled,
-            self.planner_resource_monitor.cpu_frequency,
-            self.planner_resource_monitor.total_wall_time,
-            self.planner_resource_monitor.total_cpu_time,
-            self.planner_resource_monitor.total_cpu_percent,
-            self.planner_resource_monitor.total_memory_percent,
-            self.planner_resource_monitor.node_wall_time,
-            self.planner_resource_monitor.node_cpu_time,
-            self.planner_resource_monitor.node_cpu_percent,
-            self.planner_resource_monitor.node_memory_percent,
-            self.glocal_planning_cpu_time_s
-        ])
-        # Immediately write the data to disk to avoid losing anything if the
-        # experiment gets interupted
-        self.eval_data_file.flush()
-        self.eval_voxblox_service(
-            os.path.join(self.eval_directory, "voxblox_maps",
-                         map_name + ".vxblx"))
-        self.eval_n_maps += 1
+        # NOTE: eval_finish may run on another thread, no data is recorded
+        #       once it has closed the data file
+        with self.eval_lock:
+            if self.eval_finished:
+                return
+            # Skip the data point if the previous map is still being saved, so
+            # every row has a map saved at the time of the row
+            if self.save_map_future is not None and \
+                    not self.save_map_future.done():
+                rospy.logwarn(
+                    "[ExperimentManager]: Previous voxblox map is still being "
+                    "saved, skipping the data point at %.1fs." % time_ros)
+                self.writelog("Skipped the data point at %.1fs, previous map "
+                              "still saving." % time_ros)
+            else:
+                if self.eval_n_maps >= len(self.eval_data):
+                    eval_data = np.empty(2 * len(self.eval_data),
+                                         dtype=EVAL_DATA_TYPE)
+                    eval_data[:self.eval_n_maps] = \
+                        self.eval_data[:self.eval_n_maps]
+                    self.eval_data = eval_data
+                self.eval_data[self.eval_n_maps] = (
+                    map_name, time_ros, time_real, drift_pos, drift_rot,
+                    drift_estimated_pos, drift_estimated_rot,
+                    self.distance_traveled,
+                    self.planner_resource_monitor.cpu_frequency,
+                    self.planner_resource_monitor.total_wall_time,
+                    self.planner_resource_monitor.total_cpu_time,
+                    self.planner_resource_monitor.total_cpu_percent,
+                    self.planner_resource_monitor.total_memory_percent,
+                    self.planner_resource_monitor.node_wall_time,
+                    self.planner_resource_monitor.node_cpu_time,
+                    self.planner_resource_monitor.node_cpu_percent,
+                    self.planner_resource_monitor.node_memory_percent,
+                    self.glocal_planning_cpu_time_s)
+                self.save_map_future = self.save_map_pool.submit(
+                    self.eval_voxblox_service,
+                    self.map_path_template % self.eval_n_maps)
+                self.save_map_future.add_done_callback(self.save_map_callback)
+                self.eval_n_maps += 1
+
+            # Write the data to disk in batches, the remaining rows are written
+            # when the experiment finishes
+            if self.eval_n_maps - self.eval_n_written >= self.ROW_BATCH_SIZE:
+                self.write_rows()
 
         # If the time limit is reached stop the simulation
-        if self.time_limit > 0.0:
-            if rospy.get_time(
-            ) - self.eval_rostime_0 >= self.time_limit * 60.0:
-                self.stop_experiment("Time limit reached.")
+        if time_ros >= self.time_limit_s:
+            self.stop_experiment("Time limit reached.")
+
+    def save_map_callback(self, future):
+        """ Report voxblox maps that could not be saved """
+        if future.exception() is not None:
+            rospy.logwarn("[ExperimentManager]: Failed to save voxblox map: %s",
+                          future.exception())
 
     def distance_callback(self, _):
         """ Periodically query tf to see how much distance was covered """
         # Test whether the origin point is already published
-        if self.initial_point_offset is None:
-            try:
-                (t1, r1) = self.tf_listener.lookupTransform(
-                    'initial_pose', 'odom', rospy.Time(0))
-                (t2, r2) = self.tf_listener.lookupTransform(
-                    'airsim_drone/Lidar', 'airsim_drone/Lidar_ground_truth',
-                    rospy.Time(0))
-                trans1 = np.dot(tf.transformations.translation_matrix(t1),
-                                tf.transformations.quaternion_matrix(r1))
-                trans2 = np.dot(tf.transformations.translation_matrix(t2),
-                                tf.transformations.quaternion_matrix(r2))
-                self.initial_point_offset = \
-                    tf.transformations.concatenate_matrices(trans1, trans2)
-
-            except (tf.LookupException, tf.ConnectivityException,
-                    tf.ExtrapolationException):
-                pass
+        if self.initial_point_offset is None and \
+                self.tf_buffer.can_transform(INITIAL_POSE_FRAME, ODOM_FRAME,
+                                             self.tf_latest) and \
+                self.tf_buffer.can_transform(LIDAR_FRAME,
+                                             LIDAR_GROUND_TRUTH_FRAME,
+                                             self.tf_latest):
+            transform1 = self.tf_buffer.lookup_transform(
+                INITIAL_POSE_FRAME, ODOM_FRAME, self.tf_latest).transform
+            transform2 = self.tf_buffer.lookup_transform(
+                LIDAR_FRAME, LIDAR_GROUND_TRUTH_FRAME, self.tf_latest).transform
+            self.initial_point_offset = np.dot(
+                _homogeneous_matrix_from_msg(transform1),
+                _homogeneous_matrix_from_msg(transform2))
 
         # Query position
-        t, _ = self.tf_listener.lookupTransform('odom',
-                                                'airsim_drone_ground_truth',
-                                                rospy.Time(0))
-        t = np.array(t)
+        if not self.tf_buffer.can_transform(
+                ODOM_FRAME, DRONE_GROUND_TRUTH_FRAME, self.tf_latest):
+            return
+        t = self.tf_buffer.lookup_transform(
+            ODOM_FRAME, DRONE_GROUND_TRUTH_FRAME,
+            self.tf_latest).transform.translation
+        t = np.array((t.x, t.y, t.z))
         if self.previous_position is None:
             self.previous_position = t
             return
@@ -479,9 +631,8 @@ class EvalData(object):
         # In case of simulation data being stored, maintain a log file
         if not self.evaluate:
             return
-        self.eval_log_file.write(
-            datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ") + text +
-            "\n")
+        self.eval_log_file.write("%s%s\n" % (time.strftime(
+            self.LOG_TIME_FORMAT, time.localtime()), text))
 
     def stop_experiment(self, reason):
         # Shutdown the node with proper logging, only required when experiment
@@ -490,22 +641,47 @@ class EvalData(object):
         self.shutdown_reason_known = True
         if self.evaluate:
             self.writelog(reason)
-        width = len(reason) + 4
-        rospy.loginfo("\n" + "*" * width + "\n* " + reason + " *\n" +
-                      "*" * width)
+        banner = "*" * (len(reason) + 4)
+        rospy.loginfo("\n%s\n* %s *\n%s", banner, reason, banner)
         rospy.signal_shutdown(reason)
 
+    def write_rows(self):
+        """ Write all not yet written evaluation rows to the data file """
+        rows = self.eval_data[self.eval_n_written:self.eval_n_maps].copy()
+        # Missing drift is stored as NaN but written as 0
+        for field in DRIFT_FIELDS:
+            rows[field][np.isnan(rows[field])] = 0
+        self.eval_writer.writerows(rows.tolist())
+        self.eval_n_written = self.eval_n_maps
+        self.eval_data_file.flush()
+
     def eval_finish(self):
-        self.eval_data_file.close()
+        with self.eval_lock:
+            self.eval_finished = True
+            # Write the remaining data first in case the shutdown gets
+            # escalated while waiting for pending maps
+            self.write_rows()
+            self.eval_data_file.close()
+        # Wait for pending maps to be written before counting them
+        self.save_map_pool.shutdown(wait=True)
         map_path = os.path.join(self.eval_directory, "voxblox_maps")
-        n_maps = len([
-            f for f in os.listdir(map_path)
-            if os.path.isfile(os.path.join(map_path, f))
-        ])
+        with os.scandir(map_path) as entries:
+            n_maps = sum(1 for e in entries if e.is_file())
         if not self.shutdown_reason_known:
             self.writelog("Stopping the experiment: External Interrupt.")
         self.writelog("Finished the simulation, %d/%d maps created." %
                       (n_maps, self.eval_n_maps))
+        # Only average the drift over maps where the transforms existed
+        eval_data = self.eval_data[:self.eval_n_maps]
+        if not np.isnan(eval_data['PositionDrift']).all():
+            self.writelog("Mean drift: %.3fm, %.3fdeg." %
+                          (np.nanmean(eval_data['PositionDrift']),
+                           np.nanmean(eval_data['RotationDrift'])))
+        if not np.isnan(eval_data['PositionDriftEstimated']).all():
+            self.writelog(
+                "Mean estimated drift: %.3fm, %.3fdeg." %
+                (np.nanmean(eval_data['PositionDriftEstimated']),
+                 np.nanmean(eval_data['RotationDriftEstimated'])))
         self.eval_log_file.close()
         rospy.loginfo(
             "[ExperimentManager]: On eval_data_node shutdown: closing data "